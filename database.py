@@ -1,14 +1,17 @@
 import os
 import logging
 import json # Necesario para serializar/deserializar JSONB
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 from supabase import create_client, Client
-from dotenv import load_dotenv
+from dotenv import find_dotenv, load_dotenv
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-load_dotenv()
+if os.environ.get("RENDER") is None:
+    dotenv_path = find_dotenv()
+    if dotenv_path:
+        load_dotenv(dotenv_path)
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
@@ -114,6 +117,78 @@ def update_user_priority(user_id: int, new_priority_level: int):
         logging.info(f"La nueva prioridad {new_priority_level} no es mejor que la actual {current_priority} para el usuario {user_id}.")
         return False
 
+# Códigos de error cuando la función RPC no existe: PostgREST (PGRST202) y Postgres (42883).
+_MISSING_FUNCTION_CODES = ("PGRST202", "42883")
+
+class MissingMigrationError(RuntimeError):
+    """La función apply_purchase no existe en Supabase: falta aplicar migrations/002_apply_purchase.sql."""
+
+def apply_purchase(user_id: int, points_delta: int, priority_boost: int):
+    """
+    Aplica una compra en una sola sentencia: suma 'points_delta' y deja la prioridad en
+    LEAST(actual, priority_boost). Si el usuario no existe, lo crea para que la compra NUNCA se pierda.
+    Devuelve {"points": ..., "priority_level": ...} con los valores resultantes, o None si falla.
+    Lanza MissingMigrationError si la función de migrations/002_apply_purchase.sql no está desplegada.
+    """
+    try:
+        response = supabase.rpc("apply_purchase", {
+            "p_user_id": user_id,
+            "p_points": points_delta,
+            "p_priority": priority_boost
+        }).execute()
+        if response.data:
+            result = response.data[0]
+            logging.info(f"Compra aplicada al usuario {user_id}: +{points_delta} puntos (total: {result['points']}), prioridad {result['priority_level']}.")
+            return result
+        logging.error(f"Error al aplicar la compra para el usuario {user_id}: {response.json()}.")
+        return None
+    except Exception as e:
+        if getattr(e, "code", None) in _MISSING_FUNCTION_CODES:
+            raise MissingMigrationError("La función 'apply_purchase' no existe en Supabase. Aplica migrations/002_apply_purchase.sql.") from e
+        logging.error(f"Error al aplicar la compra para el usuario {user_id}: {e}.")
+        return None
+
+# --- Funciones para la tabla 'processed_stripe_events' ---
+# Registro de eventos de Stripe ya procesados (idempotencia ante reintentos).
+# Esquema: migrations/001_processed_stripe_events.sql
+PROCESSED_EVENTS_TTL_HOURS = 24
+
+def try_insert_event(event_id: str, project: str) -> bool:
+    """
+    Registra un evento de Stripe como procesado.
+    Devuelve True si es la primera vez que se ve el evento y False si ya existía (reintento de Stripe).
+    """
+    try:
+        response = supabase.table("processed_stripe_events") \
+            .upsert({"event_id": event_id, "project": project}, on_conflict="event_id", ignore_duplicates=True) \
+            .execute()
+        return bool(response.data)
+    except Exception as e:
+        # Ante un fallo de la BD preferimos procesar el evento a perder la compra.
+        logging.error(f"Error al registrar el evento de Stripe {event_id}: {e}.")
+        return True
+
+def release_event(event_id: str):
+    """
+    Borra el registro de un evento de Stripe cuyo procesamiento falló, para que un reenvío
+    (p. ej. desde el dashboard de Stripe) no se descarte como duplicado.
+    """
+    try:
+        supabase.table("processed_stripe_events").delete().eq("event_id", event_id).execute()
+        logging.info(f"Evento de Stripe {event_id} liberado para poder reprocesarse.")
+    except Exception as e:
+        logging.error(f"Error al liberar el evento de Stripe {event_id}: {e}.")
+
+def cleanup_processed_events(max_age_hours: int = PROCESSED_EVENTS_TTL_HOURS):
+    """Elimina los eventos de Stripe procesados con más antigüedad que 'max_age_hours'."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(hours=max_age_hours)).isoformat()
+    try:
+        response = supabase.table("processed_stripe_events").delete().lt("created_at", cutoff).execute()
+        if response.data:
+            logging.info(f"Eliminados {len(response.data)} eventos de Stripe procesados anteriores a {cutoff}.")
+    except Exception as e:
+        logging.error(f"Error al limpiar eventos de Stripe procesados: {e}.")
+
 # --- Funciones para la tabla 'generation_queue' ---
 async def add_generation_job(user_id: int, chat_id: int, message_id: int, filepath: str, workflow_content: dict, selected_workflow_name: str, priority_level: int):
     job_data = {
@@ -0,0 +1,11 @@
+-- Registro de eventos de Stripe ya procesados (idempotencia ante reintentos).
+-- Usado por database.try_insert_event / database.cleanup_processed_events.
+CREATE TABLE IF NOT EXISTS processed_stripe_events (
+    event_id TEXT PRIMARY KEY,
+    project TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- La limpieza por TTL borra por antigüedad.
+CREATE INDEX IF NOT EXISTS processed_stripe_events_created_at_idx
+    ON processed_stripe_events (created_at);
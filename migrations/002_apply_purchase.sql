@@ -0,0 +1,13 @@
+-- Aplica una compra de Stripe en una sola sentencia atómica: suma los puntos y deja la
+-- prioridad en LEAST(actual, nueva). Si el usuario no existe, lo crea con prioridad
+-- LEAST(2, nueva) para que la compra NUNCA se pierda.
+-- Usado por database.apply_purchase (vía supabase.rpc).
+CREATE OR REPLACE FUNCTION apply_purchase(p_user_id BIGINT, p_points INT, p_priority INT)
+RETURNS TABLE(points INT, priority_level INT) AS $$
+    INSERT INTO usersv2v AS u (user_id, points, priority_level)
+    VALUES (p_user_id, p_points, LEAST(2, p_priority))
+    ON CONFLICT (user_id) DO UPDATE
+        SET points = u.points + EXCLUDED.points,
+            priority_level = LEAST(u.priority_level, p_priority)
+    RETURNING u.points, u.priority_level;
+$$ LANGUAGE sql;
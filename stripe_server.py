@@ -1,36 +1,60 @@
-from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, Request, Header, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse, Response
+import orjson
 import stripe
 import os
+import webhook_signature # Verificación de la cabecera Stripe-Signature
 import database  # Asegúrate de que este módulo maneja una DB en la nube (ej., Supabase)
-from dotenv import load_dotenv
-from telegram import Bot # Importa Bot para enviar mensajes de confirmación
+from dotenv import find_dotenv, load_dotenv
+import httpx # Cliente HTTP para enviar los mensajes de confirmación a la API de Telegram
+import asyncio
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+# httpx registra cada petición con su URL a nivel INFO, y la URL de Telegram incluye el BOT_TOKEN.
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
-# Carga las variables de entorno (útil para desarrollo local, Render las inyecta directamente)
-load_dotenv() 
+# Carga las variables de entorno solo en desarrollo local: Render las inyecta directamente
+# (y define RENDER), así que ahí se evita recorrer el sistema de archivos en cada arranque.
+if os.environ.get("RENDER") is None:
+    dotenv_path = find_dotenv() # Busca el .env hacia arriba desde este archivo, no desde el cwd
+    if dotenv_path:
+        load_dotenv(dotenv_path)
 
 # Configuración de Stripe con variables de entorno
 stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET")
 BOT_TOKEN = os.environ.get("BOT_TOKEN") # Asegúrate de tener este valor en Render
 
+# Cliente HTTP único para Stripe: todas las llamadas son *_async y comparten el pool de
+# conexiones de su httpx.AsyncClient, así que no se paga un handshake TLS por cada sesión de pago.
+stripe.default_http_client = stripe.http_client.HTTPXClient(timeout=10)
+
 # Asegúrate de que las claves de Stripe están configuradas
 if not stripe.api_key:
-    logging.error("La variable de entorno STRIPE_SECRET_KEY no está configurada.")
+    logger.error("La variable de entorno STRIPE_SECRET_KEY no está configurada.")
     raise ValueError("Configuración de Stripe incompleta: STRIPE_SECRET_KEY no encontrada.")
 if not STRIPE_WEBHOOK_SECRET:
-    logging.error("La variable de entorno STRIPE_WEBHOOK_SECRET no está configurada.")
+    logger.error("La variable de entorno STRIPE_WEBHOOK_SECRET no está configurada.")
     # No es un error crítico para el inicio del servidor, pero es necesario para webhooks seguros.
 
-# Instancia del Bot para enviar confirmaciones (si BOT_TOKEN está disponible)
-bot = Bot(token=BOT_TOKEN) if BOT_TOKEN else None
-if not bot:
-    logging.warning("BOT_TOKEN no configurado en el backend de Stripe. Los mensajes de confirmación no se pueden enviar a Telegram.")
+# HMAC con el secreto del webhook precalculado una sola vez; cada verificación parte de una copia.
+STRIPE_SIGNATURE_TOLERANCE = 300 # Segundos de antigüedad máxima aceptada para la firma
+_HMAC_PROTOTYPE = webhook_signature.make_hmac_prototype(STRIPE_WEBHOOK_SECRET) if STRIPE_WEBHOOK_SECRET else None
+
+def _verify_sig(payload: bytes, header: str):
+    """Verifica la cabecera 'Stripe-Signature' con el secreto de este backend."""
+    webhook_signature.verify_signature(payload, header, _HMAC_PROTOTYPE, STRIPE_SIGNATURE_TOLERANCE)
+
+# Cliente HTTP para la API de Telegram (si BOT_TOKEN está disponible). Solo se necesita
+# 'sendMessage', así que se llama directamente en lugar de cargar python-telegram-bot.
+# Se crea en el arranque y se reutiliza (HTTP/2, un solo pool de conexiones) para todos los envíos.
+telegram_client = None
+if not BOT_TOKEN:
+    logger.warning("BOT_TOKEN no configurado en el backend de Stripe. Los mensajes de confirmación no se pueden enviar a Telegram.")
 
 
 # Define tus paquetes de puntos aquí con el precio en centavos (USD)
@@ -49,13 +73,43 @@ POINT_PACKAGES = {
 # Esto es crucial para el filtrado de webhooks.
 PROJECT_IDENTIFIER = "videos2hotbot" # <--- ¡IMPORTANTE! Este es el identificador para el backend de "Monkeyvideos"
 
+# Parámetros fijos de la sesión de Checkout por paquete, precalculados al importar el módulo.
+# En cada /crear-sesion solo se añade el metadata propio del usuario.
+_PACKAGE_SESSION_KWARGS = {
+    paquete_id: {
+        "line_items": [{
+            "price_data": {
+                "currency": "mxn",
+                "unit_amount": paquete["amount"],
+                "product_data": {
+                    "name": paquete["label"]
+                }
+            },
+            "quantity": 1
+        }],
+        "mode": "payment",
+        "allow_promotion_codes": True,
+        "success_url": "https://t.me/videos2hotbot",  # URL de éxito para este bot
+        "cancel_url": "https://t.me/videos2hotbot",   # URL de cancelación para este bot
+    }
+    for paquete_id, paquete in POINT_PACKAGES.items()
+}
+_PACKAGE_METADATA = {
+    paquete_id: {
+        "package_id": paquete_id,
+        "points_awarded": paquete["points"], # También útil para el webhook
+        "project": PROJECT_IDENTIFIER        # <--- CAMBIO 2: AÑADIDO: Identificador del proyecto
+    }
+    for paquete_id, paquete in POINT_PACKAGES.items()
+}
+
 @app.post("/crear-sesion")
 async def crear_sesion(request: Request):
     """
     Endpoint para crear una sesión de pago de Stripe.
     Llamado desde tu bot de Telegram.
     """
-    data = await request.json()
+    data = orjson.loads(await request.body())
     user_id = str(data.get("telegram_user_id"))
     paquete_id = data.get("paquete_id")
     # ⬅️ Recibimos el 'priority_boost' del bot
@@ -63,141 +117,298 @@ async def crear_sesion(request: Request):
 
     # Validación
     if not user_id or paquete_id not in POINT_PACKAGES:
-        logging.error(f"Datos inválidos en /crear-sesion: user_id={user_id}, paquete_id={paquete_id}")
-        return JSONResponse(status_code=400, content={"error": "Datos inválidos: user_id o package_id incorrecto."})
+        logger.error("Datos inválidos en /crear-sesion: user_id=%s, paquete_id=%s", user_id, paquete_id)
+        return ORJSONResponse(status_code=400, content={"error": "Datos inválidos: user_id o package_id incorrecto."})
     
     # Valida que priority_boost sea un entero válido si se envía
     if priority_boost is not None and not isinstance(priority_boost, int):
-        logging.error(f"Tipo de dato inválido para priority_boost: {priority_boost}")
-        return JSONResponse(status_code=400, content={"error": "Datos inválidos: priority_boost debe ser un entero."})
-
-    paquete = POINT_PACKAGES[paquete_id]
+        logger.error("Tipo de dato inválido para priority_boost: %s", priority_boost)
+        return ORJSONResponse(status_code=400, content={"error": "Datos inválidos: priority_boost debe ser un entero."})
 
     try:
-        session = stripe.checkout.Session.create(
-            
-            line_items=[{
-                "price_data": {
-                    "currency": "mxn",
-                    "unit_amount": paquete["amount"],
-                    "product_data": {
-                        "name": paquete["label"]
-                    }
-                },
-                "quantity": 1
-            }],
-            mode="payment",
-            allow_promotion_codes=True,
-            success_url="https://t.me/videos2hotbot",  # URL de éxito para este bot
-            cancel_url="https://t.me/videos2hotbot",   # URL de cancelación para este bot
+        # Versión asíncrona: no bloquea el event loop durante el viaje de ida y vuelta a Stripe.
+        session = await stripe.checkout.Session.create_async(
+            **_PACKAGE_SESSION_KWARGS[paquete_id],
             metadata={
+                **_PACKAGE_METADATA[paquete_id],
                 "telegram_user_id": user_id,
-                "package_id": paquete_id,
-                "points_awarded": paquete["points"], # También útil para el webhook
                 "priority_boost": priority_boost,    # ⬅️ Pasamos el 'priority_boost' en el metadata
-                "project": PROJECT_IDENTIFIER        # <--- CAMBIO 2: AÑADIDO: Identificador del proyecto
             }
         )
-        logging.info(f"Sesión de Stripe creada para el usuario {user_id}, paquete {paquete_id}. URL: {session.url}")
+        logger.info("Sesión de Stripe creada para el usuario %s, paquete %s. URL: %s", user_id, paquete_id, session.url)
         return {"url": session.url}
     except Exception as e:
-        logging.error(f"Error al crear la sesión de Stripe para el usuario {user_id}, paquete {paquete_id}: {e}", exc_info=True)
-        return JSONResponse(status_code=500, content={"error": f"Error interno al crear la sesión: {str(e)}"})
+        logger.error("Error al crear la sesión de Stripe para el usuario %s, paquete %s: %s", user_id, paquete_id, e, exc_info=True)
+        return ORJSONResponse(status_code=500, content={"error": f"Error interno al crear la sesión: {str(e)}"})
+
+# Límite de llamadas simultáneas a la BD (igual al tamaño del pool de Supabase), para que una
+# ráfaga de webhooks espere su turno en lugar de agotar las conexiones. Las llamadas del cliente
+# de Supabase son síncronas, así que se ejecutan en un hilo para no bloquear el event loop.
+DB_MAX_CONCURRENCY = 10
+_DB_SEM = asyncio.Semaphore(DB_MAX_CONCURRENCY)
+
+# Cola de mensajes de confirmación de Telegram: (chat_id, texto).
+# La consume un único worker para que un Telegram lento no retenga la respuesta a Stripe.
+telegram_queue = None
+telegram_worker_task = None # Referencia para que el event loop no recolecte la tarea
+TELEGRAM_MAX_RETRIES = 3
+TELEGRAM_SHUTDOWN_TIMEOUT = 10 # Segundos que el apagado espera a que se vacíe la cola
+# Texto de confirmación de recarga; se rellena con .format() en cada envío.
+_CONFIRMATION_TEMPLATE = "🎉 **¡Recarga exitosa!** <b>{points}</b> puntos han sido añadidos a tu cuenta. Tu prioridad en la cola es ahora <b>{priority}</b> (0=Más alta)."
+
+def _telegram_retry_after(response) -> int:
+    """Segundos a esperar según un 429 de Telegram ('parameters.retry_after'); 1 si el cuerpo no es el esperado."""
+    try:
+        body = response.json()
+    except ValueError:
+        return 1
+    parameters = body.get("parameters") if isinstance(body, dict) else None
+    retry_after = _safe_int(parameters.get("retry_after")) if isinstance(parameters, dict) else None
+    return retry_after if retry_after is not None and retry_after > 0 else 1
+
+async def _telegram_worker():
+    """Consume la cola de confirmaciones y las envía a Telegram, respetando 'retry_after' ante un 429."""
+    while True:
+        chat_id, text = await telegram_queue.get()
+        try:
+            for attempt in range(1, TELEGRAM_MAX_RETRIES + 1):
+                response = await telegram_client.post("/sendMessage", json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"})
+                if response.status_code != 429:
+                    if response.is_error:
+                        logger.error("Telegram rechazó la confirmación para %s: %s %s", chat_id, response.status_code, response.text)
+                    break
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    continue # Último intento: no tiene sentido esperar antes de rendirse
+                delay = _telegram_retry_after(response)
+                logger.warning("Telegram limitó el envío a %s (intento %s). Reintentando en %ss.", chat_id, attempt, delay)
+                await asyncio.sleep(delay)
+            else:
+                logger.error("No se pudo enviar la confirmación de Telegram a %s tras %s intentos.", chat_id, TELEGRAM_MAX_RETRIES)
+        except Exception as e:
+            logger.error("Error al enviar mensaje de confirmación de Telegram para %s: %s", chat_id, e)
+        finally:
+            telegram_queue.task_done()
+
+# Cada cuánto se purgan los eventos de Stripe procesados más antiguos que el TTL de idempotencia.
+PROCESSED_EVENTS_CLEANUP_INTERVAL = 3600 # Segundos
+cleanup_task = None # Referencia para que el event loop no recolecte la tarea
+
+async def _cleanup_worker():
+    """Purga periódicamente los eventos de Stripe procesados, mientras el servidor siga vivo."""
+    while True:
+        async with _DB_SEM:
+            await asyncio.to_thread(database.cleanup_processed_events)
+        await asyncio.sleep(PROCESSED_EVENTS_CLEANUP_INTERVAL)
+
+stripe_prewarm_task = None # Referencia para que el event loop no recolecte la tarea
+
+async def _prewarm_stripe():
+    """Precalienta el pool del cliente de Stripe para que la primera /crear-sesion no pague el handshake."""
+    try:
+        await stripe.Account.retrieve_async()
+    except Exception as e:
+        logger.warning("No se pudo precalentar la conexión con Stripe: %s", e)
+
+@app.on_event("startup")
+async def on_startup():
+    global telegram_client, telegram_queue, telegram_worker_task, cleanup_task, stripe_prewarm_task
+    cleanup_task = asyncio.create_task(_cleanup_worker())
+
+    # En segundo plano: un api.stripe.com lento no debe retrasar el arranque (y con él los webhooks).
+    stripe_prewarm_task = asyncio.create_task(_prewarm_stripe())
+
+    if BOT_TOKEN:
+        telegram_client = httpx.AsyncClient(base_url=f"https://api.telegram.org/bot{BOT_TOKEN}", timeout=10, http2=True)
+        telegram_queue = asyncio.Queue()
+        telegram_worker_task = asyncio.create_task(_telegram_worker())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if cleanup_task is not None:
+        cleanup_task.cancel()
+    if telegram_worker_task is not None:
+        # Da tiempo a enviar las confirmaciones pendientes antes de cancelar el worker.
+        try:
+            await asyncio.wait_for(telegram_queue.join(), TELEGRAM_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Apagado: %s confirmaciones de Telegram en cola (más la que estuviera enviándose) no se enviaron tras %ss.", telegram_queue.qsize(), TELEGRAM_SHUTDOWN_TIMEOUT)
+        telegram_worker_task.cancel()
+    if telegram_client is not None:
+        await telegram_client.aclose()
+
+def _safe_int(value, default=None):
+    """Convierte 'value' a int si es un entero o una cadena de dígitos (con signo opcional); si no, devuelve 'default'."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        digits = value[1:] if value.startswith("-") else value
+        if digits.isdecimal():
+            return int(value)
+    return default
+
+async def _release_event(event_id: str):
+    # El evento ya se marcó como procesado en el webhook; si la compra no se aplicó, se libera
+    # para que un reenvío desde el dashboard de Stripe no se descarte como duplicado.
+    async with _DB_SEM:
+        await asyncio.to_thread(database.release_event, event_id)
+
+async def _process_checkout_completed(event_id: str, metadata: dict):
+    """
+    Procesa un evento 'checkout.session.completed' ya verificado.
+    Se ejecuta como tarea en segundo plano, después de haber respondido 200 a Stripe.
+    """
+    user_id_str = metadata.get("telegram_user_id") # Leer como string
+    package_id = metadata.get("package_id")
+
+    # Convierte los valores del metadata a int de forma segura (sin lanzar excepciones en el caso normal)
+    user_id = _safe_int(user_id_str)
+    if user_id is None:
+        logger.error("Webhook: user_id inválido o faltante en metadata: %s", user_id_str)
+        return
 
-@app.post("/webhook/stripe")
-async def stripe_webhook(request: Request, stripe_signature: str = Header(None, alias="Stripe-Signature")):
+    points_awarded = _safe_int(metadata.get("points_awarded"))
+    if points_awarded is None:
+        logger.error("Webhook: points_awarded inválido o faltante en metadata: %s", metadata.get('points_awarded'))
+        points_awarded = 0 # O maneja como error si es crítico
+
+    priority_boost = _safe_int(metadata.get("priority_boost"))
+    if priority_boost is None:
+        logger.warning("Webhook: priority_boost inválido o faltante en metadata: %s. Usando prioridad por defecto (2).", metadata.get('priority_boost'))
+        priority_boost = 2 # Usa prioridad por defecto si no se puede convertir
+
+    if package_id in POINT_PACKAGES:
+        try:
+            # Puntos y prioridad se aplican en una sola sentencia atómica (prioridad = LEAST(actual, nueva)),
+            # así que dos entregas concurrentes no se intercalan aunque vengan de workers distintos.
+            # Asegúrate de que tu database.py para Monkeyvideos usa la tabla correcta (ej. "users")
+            try:
+                async with _DB_SEM:
+                    result = await asyncio.to_thread(database.apply_purchase, user_id, points_awarded, priority_boost)
+            except database.MissingMigrationError as e:
+                logger.critical("%s Compra de %s puntos del usuario %s (evento %s) NO aplicada.", e, points_awarded, user_id, event_id)
+                await _release_event(event_id)
+                return
+
+            if result is None:
+                logger.error("No se pudo aplicar la compra de %s puntos al usuario %s (evento %s). No se envía confirmación.", points_awarded, user_id, event_id)
+                await _release_event(event_id)
+                return
+            logger.info("Usuario %s recibió %s puntos por compra en Stripe. Prioridad actual: %s.", user_id, points_awarded, result['priority_level'])
+
+            # Encola el mensaje de confirmación al usuario de Telegram
+            if telegram_queue is not None: # Solo si el cliente de Telegram y su worker se inicializaron correctamente
+                telegram_queue.put_nowait((
+                    user_id,
+                    _CONFIRMATION_TEMPLATE.format(points=points_awarded, priority=result["priority_level"]),
+                ))
+            else:
+                logger.warning("Advertencia: Bot de Telegram no inicializado en el backend de Stripe (¿TOKEN faltante?). No se pudo enviar la confirmación.")
+        except Exception as e:
+            logger.error("Error al actualizar puntos/prioridad o enviar confirmación para %s: %s", user_id, e, exc_info=True)
+    else:
+        logger.warning("Webhook recibido pero metadata incompleta o inválida: user_id=%s, package_id=%s", user_id_str, package_id)
+
+# Cuerpos de las respuestas fijas del webhook, serializados una sola vez.
+# Se crea un Response nuevo por petición (barato con bytes ya hechos) en lugar de compartir
+# una instancia: FastAPI le asigna las BackgroundTasks de la petición al Response devuelto.
+_WEBHOOK_OK_BODY = b'{"status":"ok"}'
+_WEBHOOK_IGNORED_BODY = b'{"status":"ignored","reason":"project_mismatch"}'
+_WEBHOOK_DUPLICATE_BODY = b'{"status":"duplicate"}'
+
+def _webhook_response(body: bytes) -> Response:
+    return Response(content=body, media_type="application/json", status_code=200)
+
+# Router propio del webhook: siempre devuelve un Response ya construido, así que no necesita
+# response_model ni la serialización JSON por defecto, y no se expone en el esquema OpenAPI.
+webhook_router = APIRouter(default_response_class=Response)
+
+@webhook_router.post("/webhook/stripe", response_model=None, include_in_schema=False)
+async def stripe_webhook(request: Request, background_tasks: BackgroundTasks, stripe_signature: str = Header(None, alias="Stripe-Signature")):
     """
     Endpoint que recibe webhooks de Stripe.
     Es llamado por Stripe cuando ocurren eventos como 'checkout.session.completed'.
+    Solo verifica la firma y encola el procesamiento; responde 200 de inmediato
+    para que Stripe no reintente por lentitud de la BD o de Telegram.
     """
     payload = await request.body()
 
+    # Lo ideal es registrar en el dashboard de Stripe un endpoint (con su propio secreto) por proyecto,
+    # de modo que los eventos de otros proyectos ni siquiera lleguen aquí. Como red de seguridad,
+    # el payload se inspecciona ANTES de verificar la firma: descartar un evento ajeno no requiere
+    # confiar en él, y así no se gasta el HMAC sobre el payload completo en eventos que se ignoran.
     try:
-        event = stripe.Webhook.construct_event(payload, stripe_signature, STRIPE_WEBHOOK_SECRET)
-    except stripe.error.SignatureVerificationError as e:
-        logging.error(f"Error de verificación de firma del webhook de Stripe: {e}")
-        raise HTTPException(status_code=400, detail="Firma inválida")
+        raw_event = orjson.loads(payload)
     except ValueError as e:
-        logging.error(f"Error de procesamiento de payload del webhook de Stripe: {e}")
+        logger.error("Error de procesamiento de payload del webhook de Stripe: %s", e)
         raise HTTPException(status_code=400, detail="Payload inválido")
-    
+    if not isinstance(raw_event, dict):
+        logger.error("Error de procesamiento de payload del webhook de Stripe: el evento no es un objeto JSON.")
+        raise HTTPException(status_code=400, detail="Payload inválido")
+
     # --- CAMBIO 3: INICIO DE LA LÓGICA DE FILTRADO POR METADATA DENTRO DEL WEBHOOK ---
     # Si el evento es de tipo 'checkout.session.completed', verificamos el metadata 'project'.
     # Si el evento no tiene el metadata 'project' o no coincide con este backend, lo ignoramos.
-    if event["type"] == "checkout.session.completed":
-        session_metadata = event["data"]["object"].get("metadata", {})
-        event_project = session_metadata.get("project")
+    if raw_event.get("type") == "checkout.session.completed":
+        # El payload aún no está verificado: cualquier nivel puede no ser un objeto JSON.
+        # Una forma inesperada se trata como "no es para este proyecto".
+        event_project = None
+        data = raw_event.get("data")
+        session_object = data.get("object") if isinstance(data, dict) else None
+        metadata = session_object.get("metadata") if isinstance(session_object, dict) else None
+        if isinstance(metadata, dict):
+            event_project = metadata.get("project")
 
         # Verifica si el identificador del proyecto en el metadata del evento
         # NO coincide con el identificador de ESTE backend.
         if event_project != PROJECT_IDENTIFIER:
-            logging.info(f"Webhook recibido para el proyecto '{event_project}', pero este backend es '{PROJECT_IDENTIFIER}'. Ignorando evento.")
+            # DEBUG y truncado: el valor de 'project' lo envía un remitente aún no verificado.
+            logger.debug("Webhook recibido para el proyecto '%.64s', pero este backend es '%s'. Ignorando evento.", event_project, PROJECT_IDENTIFIER)
             # Es crucial devolver un 200 OK para que Stripe no reintente el envío.
-            return JSONResponse(status_code=200, content={"status": "ignored", "reason": "project_mismatch"})
-    # --- FIN DE LA LÓGICA DE FILTRADO POR METADATA ---
-
-    # El resto del código del webhook solo se ejecuta si el filtro pasó (es decir, el evento es para este proyecto)
-    # Handle checkout session completed event
-    if event["type"] == "checkout.session.completed": # Esta condición se repite, pero es para claridad después del filtro.
-        session = event["data"]["object"]
-        metadata = session.get("metadata", {})
-        user_id_str = metadata.get("telegram_user_id") # Leer como string
-        package_id = metadata.get("package_id")
-        points_awarded = metadata.get("points_awarded") # Puntos a otorgar
-        priority_boost = metadata.get("priority_boost") # ⬅️ Recupera el 'priority_boost'
-
-        # Convierte user_id a int de forma segura
-        try:
-            user_id = int(user_id_str)
-        except (ValueError, TypeError):
-            logging.error(f"Webhook: user_id inválido o faltante en metadata: {user_id_str}")
-            return JSONResponse(status_code=400, content={"status": "error", "message": "user_id inválido en metadata"})
+            return _webhook_response(_WEBHOOK_IGNORED_BODY)
+        # --- FIN DE LA LÓGICA DE FILTRADO POR METADATA ---
 
-        # Convierte points_awarded a int de forma segura
-        try:
-            points_awarded = int(points_awarded)
-        except (ValueError, TypeError):
-            logging.error(f"Webhook: points_awarded inválido o faltante en metadata: {points_awarded}")
-            points_awarded = 0 # O maneja como error si es crítico
+    # Solo los eventos que este backend va a procesar pagan la verificación de firma.
+    try:
+        _verify_sig(payload, stripe_signature)
+    except stripe.error.SignatureVerificationError as e:
+        logger.error("Error de verificación de firma del webhook de Stripe: %s", e)
+        raise HTTPException(status_code=400, detail="Firma inválida")
 
-        # Convierte priority_boost a int de forma segura
-        try:
-            priority_boost = int(priority_boost)
-        except (ValueError, TypeError):
-            logging.warning(f"Webhook: priority_boost inválido o faltante en metadata: {priority_boost}. Usando prioridad por defecto (2).")
-            priority_boost = 2 # Usa prioridad por defecto si no se puede convertir
+    # El evento es para este proyecto (o no lleva filtro): ahora sí se construye el stripe.Event.
+    event = stripe.Event.construct_from(raw_event, stripe.api_key)
 
-        if user_id is not None and package_id in POINT_PACKAGES:
-            try:
-                # Actualiza los puntos del usuario
-                # Asegúrate de que tu database.py para Monkeyvideos usa la tabla correcta (ej. "users")
-                database.update_user_points(user_id, points_awarded)
-                logging.info(f"Usuario {user_id} recibió {points_awarded} puntos por compra en Stripe.")
-
-                # ⬅️ Actualiza la prioridad del usuario
-                # Solo actualizamos si la nueva prioridad es "mejor" (numéricamente menor)
-                database.update_user_priority(user_id, priority_boost)
-                logging.info(f"Prioridad del usuario {user_id} actualizada a {priority_boost} (if better).")
-
-                # Envía mensaje de confirmación al usuario de Telegram
-                if bot: # Solo intenta enviar si el bot se inicializó correctamente
-                    try:
-                        await bot.send_message(
-                            chat_id=user_id,
-                            text=f"🎉 **¡Recarga exitosa!** <b>{points_awarded}</b> puntos han sido añadidos a tu cuenta. Tu prioridad en la cola es ahora <b>{priority_boost}</b> (0=Más alta).",
-                            parse_mode="HTML"
-                        )
-                    except Exception as e:
-                        logging.error(f"Error al enviar mensaje de confirmación de Telegram para {user_id}: {e}")
-                else:
-                    logging.warning("Advertencia: Bot de Telegram no inicializado en el backend de Stripe (¿TOKEN faltante?). No se pudo enviar la confirmación.")
-            except Exception as e:
-                logging.error(f"Error al actualizar puntos/prioridad o enviar confirmación para {user_id}: {e}", exc_info=True)
-        else:
-            logging.warning(f"Webhook recibido pero metadata incompleta o inválida: user_id={user_id_str}, package_id={package_id}")
+    if event["type"] == "checkout.session.completed":
+        session_metadata = event["data"]["object"].get("metadata", {})
+
+        # Stripe entrega "al menos una vez": si el evento ya fue registrado, es un reintento y no se vuelve a acreditar.
+        async with _DB_SEM:
+            is_new_event = await asyncio.to_thread(database.try_insert_event, event["id"], PROJECT_IDENTIFIER)
+        if not is_new_event:
+            logger.info("Webhook duplicado para el evento %s. Ignorando.", event['id'])
+            return _webhook_response(_WEBHOOK_DUPLICATE_BODY)
+
+        # El evento es para este proyecto: se procesa en segundo plano tras responder a Stripe.
+        background_tasks.add_task(_process_checkout_completed, event["id"], dict(session_metadata))
 
     # Puedes manejar otros tipos de eventos de Stripe aquí si es necesario
     # elif event["type"] == "payment_intent.succeeded":
-    #     logging.info("¡Payment Intent exitoso!")
+    #     logger.info("¡Payment Intent exitoso!")
+
+    return _webhook_response(_WEBHOOK_OK_BODY)
+
+app.include_router(webhook_router)
 
-    return JSONResponse(status_code=200, content={"status": "ok"})
+if __name__ == "__main__":
+    import uvicorn
+    # En Render: uvicorn stripe_server:app --host 0.0.0.0 --port $PORT
+    # loop/http "auto" usan uvloop y httptools cuando están instalados (uvloop no existe en Windows).
+    # Cada worker es un proceso aparte con su propia cola y cliente de Telegram; lo que debe
+    # coordinarse entre workers (idempotencia, saldo de puntos) vive en la BD.
+    uvicorn.run(
+        "stripe_server:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8000)),
+        loop="auto",
+        http="auto",
+        workers=int(os.environ.get("WEB_CONCURRENCY", 1)),
+    )
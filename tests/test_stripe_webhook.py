@@ -0,0 +1,114 @@
+import hashlib
+import hmac
+import importlib
+import sys
+import time
+import types
+
+import orjson
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient
+
+SECRET = "whsec_test_secret"
+PROJECT = "videos2hotbot"
+
+
+@pytest.fixture
+def fake_database():
+    db = types.ModuleType("database")
+    db.inserted_events = []
+    db.try_insert_event = lambda event_id, project: db.inserted_events.append(event_id) or True
+    db.apply_purchase = lambda user_id, points, priority: {"points": points, "priority_level": priority}
+    db.release_event = lambda event_id: None
+    db.cleanup_processed_events = lambda: None
+    db.MissingMigrationError = RuntimeError
+    return db
+
+
+@pytest.fixture
+def client(monkeypatch, fake_database):
+    monkeypatch.setenv("STRIPE_SECRET_KEY", "sk_test_dummy")
+    monkeypatch.setenv("STRIPE_WEBHOOK_SECRET", SECRET)
+    monkeypatch.setenv("RENDER", "1")
+    monkeypatch.delenv("BOT_TOKEN", raising=False)
+    monkeypatch.setitem(sys.modules, "database", fake_database)
+    monkeypatch.delitem(sys.modules, "stripe_server", raising=False)
+    stripe_server = importlib.import_module("stripe_server")
+    # Sin context manager: no se ejecutan los eventos de arranque (Stripe, Telegram, limpieza).
+    return TestClient(stripe_server.app)
+
+
+def checkout_event(metadata) -> bytes:
+    return orjson.dumps({
+        "id": "evt_test",
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {"object": "checkout.session", "metadata": metadata}},
+    })
+
+
+def signature_header(payload: bytes, secret: str = SECRET) -> str:
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode("utf-8"), f"{timestamp}.".encode("utf-8") + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def post_webhook(client, payload: bytes, header=None):
+    headers = {"Stripe-Signature": header} if header is not None else {}
+    return client.post("/webhook/stripe", content=payload, headers=headers)
+
+
+OWN_METADATA = {"project": PROJECT, "telegram_user_id": "42", "package_id": "p200", "points_awarded": "500", "priority_boost": "1"}
+
+
+def test_signed_event_for_this_project_is_accepted(client, fake_database):
+    payload = checkout_event(OWN_METADATA)
+    response = post_webhook(client, payload, signature_header(payload))
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+    assert fake_database.inserted_events == ["evt_test"]
+
+
+@pytest.mark.parametrize("header", [None, "t=1,v1=" + "0" * 64, "garbage"])
+def test_unsigned_or_badly_signed_event_for_this_project_is_rejected(client, fake_database, header):
+    response = post_webhook(client, checkout_event(OWN_METADATA), header)
+    assert response.status_code == 400
+    assert fake_database.inserted_events == []
+
+
+def test_event_signed_with_another_secret_is_rejected(client, fake_database):
+    payload = checkout_event(OWN_METADATA)
+    response = post_webhook(client, payload, signature_header(payload, secret="whsec_other"))
+    assert response.status_code == 400
+    assert fake_database.inserted_events == []
+
+
+def test_event_for_another_project_is_ignored_without_signature(client, fake_database):
+    payload = checkout_event({**OWN_METADATA, "project": "otro_proyecto"})
+    response = post_webhook(client, payload)
+    assert response.status_code == 200
+    assert response.json() == {"status": "ignored", "reason": "project_mismatch"}
+    assert fake_database.inserted_events == []
+
+
+@pytest.mark.parametrize("event", [
+    {"type": "checkout.session.completed"},
+    {"type": "checkout.session.completed", "data": None},
+    {"type": "checkout.session.completed", "data": [1]},
+    {"type": "checkout.session.completed", "data": {"object": None}},
+    {"type": "checkout.session.completed", "data": {"object": "cs_test"}},
+    {"type": "checkout.session.completed", "data": {"object": {"metadata": None}}},
+    {"type": "checkout.session.completed", "data": {"object": {"metadata": ["project"]}}},
+])
+def test_malformed_checkout_event_is_ignored(client, fake_database, event):
+    response = post_webhook(client, orjson.dumps(event))
+    assert response.status_code == 200
+    assert response.json() == {"status": "ignored", "reason": "project_mismatch"}
+    assert fake_database.inserted_events == []
+
+
+@pytest.mark.parametrize("payload", [b"not json", b"[1, 2]"])
+def test_invalid_payload_is_rejected(client, payload):
+    assert post_webhook(client, payload).status_code == 400
@@ -0,0 +1,88 @@
+import hashlib
+import hmac
+import time
+
+import pytest
+import stripe
+
+import webhook_signature
+
+SECRET = "whsec_test_secret"
+PAYLOAD = b'{"id":"evt_test","type":"checkout.session.completed"}'
+
+
+def sign(payload: bytes, timestamp: int, secret: str = SECRET) -> str:
+    signed = f"{timestamp}.".encode("utf-8") + payload
+    return hmac.new(secret.encode("utf-8"), signed, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture
+def prototype():
+    return webhook_signature.make_hmac_prototype(SECRET)
+
+
+def test_valid_header_passes(prototype):
+    timestamp = int(time.time())
+    header = f"t={timestamp},v1={sign(PAYLOAD, timestamp)}"
+    webhook_signature.verify_signature(PAYLOAD, header, prototype)
+
+
+def test_any_matching_v1_passes(prototype):
+    timestamp = int(time.time())
+    header = f"t={timestamp},v1={'0' * 64},v1={sign(PAYLOAD, timestamp)},v0=legacy"
+    webhook_signature.verify_signature(PAYLOAD, header, prototype)
+
+
+def test_matches_stripe_verifier(prototype):
+    timestamp = int(time.time())
+    header = f"t={timestamp},v1={sign(PAYLOAD, timestamp)}"
+    assert stripe.WebhookSignature.verify_header(PAYLOAD.decode("utf-8"), header, SECRET, tolerance=300)
+    webhook_signature.verify_signature(PAYLOAD, header, prototype)
+
+
+def test_prototype_is_reusable(prototype):
+    for _ in range(2):
+        timestamp = int(time.time())
+        header = f"t={timestamp},v1={sign(PAYLOAD, timestamp)}"
+        webhook_signature.verify_signature(PAYLOAD, header, prototype)
+
+
+def test_tampered_payload_rejected(prototype):
+    timestamp = int(time.time())
+    header = f"t={timestamp},v1={sign(PAYLOAD, timestamp)}"
+    with pytest.raises(stripe.error.SignatureVerificationError):
+        webhook_signature.verify_signature(PAYLOAD.replace(b"evt_test", b"evt_forged"), header, prototype)
+
+
+def test_wrong_secret_rejected(prototype):
+    timestamp = int(time.time())
+    header = f"t={timestamp},v1={sign(PAYLOAD, timestamp, secret='whsec_other')}"
+    with pytest.raises(stripe.error.SignatureVerificationError):
+        webhook_signature.verify_signature(PAYLOAD, header, prototype)
+
+
+def test_expired_timestamp_rejected(prototype):
+    timestamp = int(time.time()) - 301
+    header = f"t={timestamp},v1={sign(PAYLOAD, timestamp)}"
+    with pytest.raises(stripe.error.SignatureVerificationError):
+        webhook_signature.verify_signature(PAYLOAD, header, prototype, tolerance=300)
+
+
+def test_missing_v1_rejected(prototype):
+    timestamp = int(time.time())
+    header = f"t={timestamp},v0={sign(PAYLOAD, timestamp)}"
+    with pytest.raises(stripe.error.SignatureVerificationError):
+        webhook_signature.verify_signature(PAYLOAD, header, prototype)
+
+
+@pytest.mark.parametrize("header", [None, "", "v1=abc", "t=,v1=abc", "t=²,v1=abc", "t=12a,v1=abc", "t=" + "9" * 5000 + ",v1=ab"])
+def test_malformed_header_rejected(prototype, header):
+    with pytest.raises(stripe.error.SignatureVerificationError):
+        webhook_signature.verify_signature(PAYLOAD, header, prototype)
+
+
+def test_missing_secret_rejected():
+    timestamp = int(time.time())
+    header = f"t={timestamp},v1={sign(PAYLOAD, timestamp)}"
+    with pytest.raises(stripe.error.SignatureVerificationError):
+        webhook_signature.verify_signature(PAYLOAD, header, None)
@@ -0,0 +1,44 @@
+import hashlib
+import hmac
+import time
+
+import stripe
+
+MAX_TIMESTAMP_DIGITS = 12 # Un timestamp Unix en segundos tiene 10 dígitos hasta el año 2286
+
+def make_hmac_prototype(secret: str):
+    """Crea el HMAC-SHA256 con el secreto del webhook; cada verificación trabaja sobre una copia."""
+    return hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+
+def verify_signature(payload: bytes, header: str, hmac_prototype, tolerance: int = 300):
+    """
+    Verifica la cabecera 'Stripe-Signature' (t=<timestamp>,v1=<firma>,...) contra el payload.
+    Lanza stripe.error.SignatureVerificationError si la firma no es válida, igual que el verificador de Stripe.
+    """
+    if hmac_prototype is None:
+        raise stripe.error.SignatureVerificationError("STRIPE_WEBHOOK_SECRET no configurado", header)
+    if not header:
+        raise stripe.error.SignatureVerificationError("Cabecera Stripe-Signature ausente", header)
+
+    timestamp = None
+    signatures = []
+    for item in header.split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+
+    # isdecimal() en lugar de isdigit(): '²' es un dígito pero int() no lo acepta.
+    # La longitud se limita porque int() rechaza cadenas de más de 4300 dígitos con ValueError.
+    if not timestamp or len(timestamp) > MAX_TIMESTAMP_DIGITS or not timestamp.isascii() or not timestamp.isdecimal() or not signatures:
+        raise stripe.error.SignatureVerificationError("Formato de cabecera Stripe-Signature inválido", header)
+    if int(timestamp) < time.time() - tolerance:
+        raise stripe.error.SignatureVerificationError("Timestamp fuera de la tolerancia", header)
+
+    mac = hmac_prototype.copy()
+    mac.update(timestamp.encode("ascii") + b".")
+    mac.update(payload)
+    expected = mac.hexdigest()
+    if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+        raise stripe.error.SignatureVerificationError("Ninguna firma coincide con el payload", header)